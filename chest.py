@@ -1,24 +1,101 @@
+import mmap as mmap_module
+import os
 from io import FileIO
 from mmap import ACCESS_READ, mmap
+from array import array
+from bisect import bisect_left, insort
+from collections import defaultdict
 from pathlib import Path
-from struct import Struct, unpack_from
+from struct import Struct
 # from sortedcontainers import SortedList
-from concurrent.futures import Future
-from typing import Dict, List, Literal, Mapping, MutableMapping, Tuple
+from typing import Dict, List, Literal, Mapping, MutableMapping, Set, Tuple
 
 data_struct = Struct("i") # signed int 32
-index_struct = Struct("II") # two Uint 32's
+index_struct = Struct("II") # two Uint 32's, key and position of the value
+MAX_KEY = 0xFFFFFFFF
+# position of a deleted key's row, no record can start there
+TOMBSTONE = 0xFFFFFFFF
 
 pack = data_struct.pack
-unpack = data_struct.unpack
 
-buf = memoryview(bytearray(4))
+PAGESIZE = mmap_module.PAGESIZE
+# madvise and its flags only exist on unix, elsewhere they're None and the hint is skipped
+MADV_SEQUENTIAL = getattr(mmap_module, "MADV_SEQUENTIAL", None)
+MADV_RANDOM = getattr(mmap_module, "MADV_RANDOM", None)
+MADV_WILLNEED = getattr(mmap_module, "MADV_WILLNEED", None)
 
 
+def _madvise(mm: mmap, flag: int | None):
+    if flag is not None:
+        mm.madvise(flag)
+
+
+def _willneed(mm: mmap, start: int, end: int):
+    # under MADV_RANDOM a record spanning several pages faults them in one at a time,
+    # requesting the whole range up front turns that into a single read
+    if end - (first := start & -PAGESIZE) > PAGESIZE and MADV_WILLNEED is not None:
+        mm.madvise(MADV_WILLNEED, first, end - first)
+
+
+# positional writes, a single syscall that leaves the file position alone.
+# pwrite and pwritev are missing on windows, fall back to seek + write there
+if hasattr(os, "pwrite"):
+    _pwrite = os.pwrite
+else:
+    def _pwrite(fd: int, data: bytes, offset: int):
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.write(fd, data)
+
+
+if hasattr(os, "pwritev"):
+    # more buffers than IOV_MAX in one call is rejected with EINVAL, longer lists go out in chunks
+    IOV_MAX = os.sysconf("SC_IOV_MAX") if "SC_IOV_MAX" in os.sysconf_names else 1024
+
+    def _pwritev(fd: int, buffers: List[bytes], offset: int):
+        if len(buffers) <= IOV_MAX:
+            return os.pwritev(fd, buffers, offset)
+        written = 0
+        for i in range(0, len(buffers), IOV_MAX):
+            written += os.pwritev(fd, buffers[i : i + IOV_MAX], offset + written)
+        return written
+else:
+    def _pwritev(fd: int, buffers: List[bytes], offset: int):
+        return _pwrite(fd, b"".join(buffers), offset)
+
+
+# posix_fallocate is missing on windows and macos, there the file just grows with the writes
+_fallocate = getattr(os, "posix_fallocate", None)
+
+
+def _load_index(rows, data) -> Dict[int, Tuple[int, int]]:
+    # dict presizing isn't exposed to python, what can be saved is the per row work.
+    # Zipping strided views over the rows is ~1.5x faster than unpacking them one by one,
+    # and reads mmaps and bytearrays in place.
+    with memoryview(rows) as view, view.cast("I") as columns:
+        positions = dict(zip(columns[0::2], columns[1::2]))
+    # the index file only holds positions, sizes are read from the prefixes once here.
+    # Later rows of a key override earlier ones and deleted keys end on a tombstone,
+    # so only live records get read
+    unpack_at = data_struct.unpack_from
+    return {key: (pos, unpack_at(data, pos)[0]) for key, pos in positions.items() if pos != TOMBSTONE}
+
+
+# posix_fadvise is missing on windows and macos, the hints are skipped there
+if hasattr(os, "posix_fadvise"):
+    FADV_SEQUENTIAL = os.POSIX_FADV_SEQUENTIAL
+    FADV_RANDOM = os.POSIX_FADV_RANDOM
+
+    def _fadvise(fd: int, advice: int):
+        os.posix_fadvise(fd, 0, 0, advice)
+else:
+    FADV_SEQUENTIAL = FADV_RANDOM = None
+
+    def _fadvise(fd: int, advice: int):
+        pass
+
 
 class _BaseChestDB:
 
-    BUFFER_SIZE = 0x200
     PREFIX_SIZE = 0x04
 
     def __init__(self, path: Path):
@@ -32,8 +109,10 @@ class _BaseChestDB:
         self._datafile: Path = path.with_suffix(".bin")
 
         # The index is an in-memory dict, mirroring the index file.
-        # It maps indexes to their position in the datafile
-        self._index: Dict[int, int] = dict()
+        # It maps indexes to the position and size of their value in the datafile.
+        # Only positions are stored on disk, sizes are read from the prefixes once when loading
+        # so reads never have to look at the size prefix in the datafile.
+        self._index: Dict[int, Tuple[int, int]] = dict()
 
     def __enter__(self):
         return self
@@ -51,24 +130,29 @@ class _RO_ChestDatabase(_BaseChestDB, Mapping):
                 f"""File can't be found, use access_mode='r+' if you wan to create it.\nPath: <{self._indexfile.absolute()}>,
                     """
             )
-        # initializing a packer and unpacker wich will be used for the index.
-        self._row_unpack = index_struct.iter_unpack
-
         self._indexfile: FileIO = self._indexfile.open("rb",)
         self._datafile: FileIO = self._datafile.open("rb")
 
         self.fh_index = mmap(self._indexfile.fileno(), 0, access=ACCESS_READ)
         self.fh_data = mmap(self._datafile.fileno(), 0, access=ACCESS_READ)
 
-        self._index = dict(self._row_unpack(self.fh_index.read()))
+        # the index is read front to back exactly once, let the kernel read ahead aggressively
+        _fadvise(self._indexfile.fileno(), FADV_SEQUENTIAL)
+        _madvise(self.fh_index, MADV_SEQUENTIAL)
+        # records are fetched by key at arbitrary offsets, readahead would only pull in unrelated records
+        _fadvise(self._datafile.fileno(), FADV_RANDOM)
+        _madvise(self.fh_data, MADV_RANDOM)
+
+        self._index = _load_index(self.fh_index, self.fh_data)
 
     def __getitem__(self, key: int) -> bytes:
 
-        pos = self._index[key]  # may raise KeyError
-        self.fh_data.seek(pos)
-        siz = unpack_from("I", self.fh_data[:4])[0] # I is used, we assume when it's found in the index, that the length will be positive
+        pos, siz = self._index[key]  # may raise KeyError
+        data = self.fh_data
+        end = pos + siz + 4
+        _willneed(data, pos, end)
 
-        return self.fh_data[pos + 4 : pos + siz + 4]
+        return data[pos + 4 : end]
 
     def __enter__(self):
         return self
@@ -90,191 +174,372 @@ class _RO_ChestDatabase(_BaseChestDB, Mapping):
 
 class _RW_ChestDatabase(_BaseChestDB, MutableMapping):
     MIN_BLOCKSIZE = 0x10
+    # appends are flushed once this many bytes or buffers (IOV_MAX is 1024 on linux) are queued
+    WRITE_BUFFER_SIZE = 0x10000
+    WRITE_BATCH = 0x400
+    # below this a value is copied behind its prefix, one buffer is cheaper than an extra iovec
+    CONCAT_LIMIT = 0x1000
+    # the datafile is grown in steps of at least this much ahead of the appends, see _flush_appends
+    PREALLOCATE = 0x100000
+    # new index rows are written out after this many, so a crash doesn't lose the whole session
+    COMMIT_EVERY = 0x400
 
     def __init__(self, path: Path, mode: Literal["r", "r+"] = "r"):
         super().__init__(path)
-        # free_blocks keep track of the free blocks in the file.
-        # These free bocks might be reused later on.
-        # fragments are blocks that can't be reused, (too small).
-        self._free_space: List[Tuple[int, int]] = []
-        self._fragments: List[Tuple[int, int]] = []
-
-        # initializing a packer and unpacker wich will be used for the index.
-        self._row_pack = index_struct.pack
+        # free_by_start (pos -> size) and free_by_end (end -> pos) keep track of the free blocks in the file.
+        # These free bocks might be reused later on. Blocks touching a new free block are
+        # found with one lookup on each side, so coalescing doesn't depend on the number of free blocks.
+        self._free_by_start: Dict[int, int] = {}
+        self._free_by_end: Dict[int, int] = {}
+        # the same blocks ordered on size for best fit lookups, packed as size << 32 | pos
+        # so a single bisect finds the smallest block of at least a given size
+        self._free_by_size = array("q")
+        # blocks smaller than MIN_BLOCKSIZE are pooled on their exact size instead,
+        # the many small frees and claims of small values don't shift the array around
+        self._free_small: Dict[int, Set[int]] = defaultdict(set)
+
+        # initializing a packer wich will be used for the index.
         self._row_pack_into = index_struct.pack_into
-        self._row_unpack = index_struct.iter_unpack
 
         self._indexfile.touch(exist_ok=True)
         self._datafile.touch(exist_ok=True)
 
         self.fh_index = self._indexfile.open("rb+", buffering=0)
         self.fh_data = self._datafile.open("rb+", buffering=0)
-        self._buffer = bytearray(self.fh_index.read())
-        self._index = dict(self._row_unpack(self._buffer))
+        self._data_fd = self.fh_data.fileno()
+
+        # same access pattern as the read only database, one full read of the index, random access on the data
+        _fadvise(self.fh_index.fileno(), FADV_SEQUENTIAL)
+        _fadvise(self._data_fd, FADV_RANDOM)
+
+        # appends are queued in _pending and written in batches, see _addval.
+        # _eof is where the next append goes, _flushed is where the data on disk ends
+        # and _allocated is where the file ends, it runs ahead of the data.
+        self._pending: List[bytes] = []
+        self._eof = self._flushed = self._allocated = os.fstat(self._data_fd).st_size
+
+        # reads go through a mapping of the datafile, writes still go through fh_data.
+        # The mapping only covers the file as it was when mapped, see _map_data.
+        self._data_map: mmap = None
+        self._mapped = 0
+        self._map_data()
+
+        # the rows on disk are read straight from a mapping, they're never needed again after this.
+        # The sizes come from the datafile so it has to be mapped first.
+        # Rows are only appended so _buffer only holds the ones added since the last commit,
+        # _committed is where they go in the index file.
+        self._committed = os.fstat(self.fh_index.fileno()).st_size
+        if self._committed:  # an empty file can't be mapped
+            with mmap(self.fh_index.fileno(), 0, access=ACCESS_READ) as rows:
+                self._index = _load_index(rows, self._data_map)
+        # _buffer grows by doubling, _blen is how much of it holds rows.
+        self._buffer = bytearray()
+        self._blen = 0
 
         self._populate_free_blocks()
 
-    def _populate_free_blocks(self):
-        data = self.fh_data
-        buff = buf
-        data.seek(0)
+    def _map_data(self):
+        # records appended after mapping are picked up by remapping on first access,
+        # an empty file can't be mapped at all so that waits until the first write.
+        self._flush_appends()
+        if self._data_map is not None:
+            self._data_map.close()
+            self._data_map = None
 
-        while data.readinto(buff) == 4:
-            size = unpack(buff)[0] #has to be signed
+        self._mapped = os.fstat(self._data_fd).st_size
+        if self._mapped:
+            self._data_map = mmap(self._data_fd, self._mapped, access=ACCESS_READ)
+            _madvise(self._data_map, MADV_RANDOM)
 
-            if size < 0:
-                size = ~size
-                pos = data.tell()
-                # todo fix redundant shizzle
-                self._setfree(pos - 4, size)
-            data.seek(size, 1)
+    def _populate_free_blocks(self):
+        # the index already knows where every live record is, so the free blocks are the gaps between them.
+        # Sorting the records runs in C where walking the chain of size prefixes was a python loop
+        # per record, and neighbouring free blocks come out merged.
+        data = self._data_map
+        unpack_at = data_struct.unpack_from
+        prefix = self.PREFIX_SIZE
+        by_start = self._free_by_start
+        by_end = self._free_by_end
+        pos = 0
+
+        # the end of the file closes off the last gap
+        for rec_pos, rec_siz in [*sorted(self._index.values()), (self._mapped, -prefix)]:
+            if rec_pos - pos >= prefix:
+                size = rec_pos - pos - prefix
+                by_start[pos] = size
+                by_end[rec_pos] = pos
+                # a gap made of several blocks on disk only gets a header covering all of it here
+                if unpack_at(data, pos)[0] != ~size:
+                    _pwrite(self._data_fd, pack(~size), pos)
+            pos = max(pos, rec_pos + rec_siz + prefix)
+
+        small = self._free_small
+        sized = []
+        for free_pos, free_size in by_start.items():
+            if free_size < self.MIN_BLOCKSIZE:
+                small[free_size].add(free_pos)
+            else:
+                sized.append(free_size << 32 | free_pos)
+        self._free_by_size = array("q", sorted(sized))
 
     def commit(self, cleanup=False):
 
+        # the index must never point past the data on disk
+        self._flush_appends()
+
+        # nothing added or deleted since the last commit, the file is already compact
+        if cleanup and not self._blen and len(self._index) * index_struct.size == self._committed:
+            cleanup = False
+
         if cleanup:
             # putting everything in local scope speeds up the loop by 30%
             ind = self._index
-            buf = self._buffer
             p = self._row_pack_into
+            row = index_struct.size
+            buf = self._buffer
+
+            # drop the rows of overwritten and deleted keys, the whole file gets rewritten
+            self._blen = len(ind) * row
+            self._committed = 0
+            if self._blen > len(buf):
+                buf.extend(bytes(self._blen - len(buf)))
 
-            for i, k in enumerate(ind):
-                p(buf, i * 8, k, ind[k])
+            for i, (k, (pos, _)) in enumerate(ind.items()):
+                p(buf, i * row, k, pos)
 
-        self.fh_index.seek(0)
-        self.fh_index.write(self._buffer)
+        with memoryview(self._buffer) as view:
+            _pwrite(self.fh_index.fileno(), view[: self._blen], self._committed)
+        self._committed += self._blen
+        self._blen = 0
 
         if cleanup:
-            self.fh_index.truncate(len(self._index) * 8)
+            self.fh_index.truncate(self._committed)
 
-    def _addval(self, key, val: bytes):
-        self.fh_data.seek(0, 2)
+    def _add_row(self, key, pos: int, siz: int):
+        self._index[key] = (pos, siz)
+        self._append_row(key, pos)
 
-        pos = self.fh_data.tell()
-        self.fh_data.write(pack(len(val)) + val)
-        self._buffer.extend(self._row_pack(key, pos))
-        self._index[key] = pos
+    def _append_row(self, key, pos: int):
+        # rows are packed straight into the buffer, which doubles when it runs out instead of
+        # reallocating on every extend
+        end = self._blen + index_struct.size
+        if end > len(self._buffer):
+            self._buffer.extend(bytes(max(len(self._buffer), 0x1000)))
 
-    def _setval(self, key, val: bytes, pos: int):
-        self.fh_data.seek(pos)
-        self.fh_data.write(pack(len(val)) + val)
+        self._row_pack_into(self._buffer, self._blen, key, pos)
+        self._blen = end
 
-        self._buffer.extend(self._row_pack(key, pos))
-        self._index[key] = pos
+        # only appends the rows added since the last commit, the index file isn't rewritten
+        if end >= self.COMMIT_EVERY * index_struct.size:
+            self.commit()
 
-    def __getitem__(self, key: int | str | bytes) -> bytes:
+    def _addval(self, key, val: bytes):
+        # only the end of the file grows, so the position is known before anything is written.
+        # Large values are queued next to their prefix, no concatenated copy is made.
+        pos = self._eof
+        pending = self._pending
+        # a value queues one or two buffers, flush first so the batch never goes past WRITE_BATCH
+        if len(pending) + 2 > self.WRITE_BATCH:
+            self._flush_appends()
+        if len(val) < self.CONCAT_LIMIT:
+            pending.append(pack(len(val)) + val)
+        else:
+            pending.append(pack(len(val)))
+            pending.append(bytes(val))  # no copy for bytes, but a bytearray could change while queued
+        self._eof = pos + len(val) + self.PREFIX_SIZE
+
+        if self._eof - self._flushed >= self.WRITE_BUFFER_SIZE:
+            self._flush_appends()
+
+        self._add_row(key, pos, len(val))
+
+    def _flush_appends(self):
+        # one vectored write for every append queued since the last flush
+        if self._pending:
+            # reserving the blocks up front saves the filesystem from allocating on every flush
+            if self._eof > self._allocated and _fallocate is not None:
+                size = max(self._eof - self._allocated, self.PREALLOCATE, self._allocated >> 3)
+                _fallocate(self._data_fd, self._allocated, size)
+                self._allocated += size
+            _pwritev(self._data_fd, self._pending, self._flushed)
+            self._pending.clear()
+            self._flushed = self._eof
+
+    def _setval(self, key, val: bytes, pos: int, tail: bytes = b""):
+        # tail is the header of a free block right behind the value, it goes out in the same write
+        if pos >= self._flushed:
+            self._flush_appends()
+        # prefix and value as two buffers of one vectored write, no concatenated copy of large values
+        if len(val) < self.CONCAT_LIMIT:
+            _pwrite(self._data_fd, pack(len(val)) + val + tail, pos)
+        else:
+            _pwritev(self._data_fd, [pack(len(val)), val, tail], pos)
 
-        pos = self._index[key]  # may raise KeyError
+        self._add_row(key, pos, len(val))
 
-        self.fh_data.seek(pos)
-        dat = self.fh_data.read(self.BUFFER_SIZE)
-        siz = unpack(dat[: 4])[0]
+    def __getitem__(self, key: int) -> bytes:
 
-        if siz > (x := (self.BUFFER_SIZE - self.PREFIX_SIZE)):
-            dat += self.fh_data.read(siz - x)
+        pos, siz = self._index[key]  # may raise KeyError
+        start = pos + self.PREFIX_SIZE
+        end = start + siz
 
-        dat = dat[self.PREFIX_SIZE : siz + self.PREFIX_SIZE]
-        return dat
+        # the value may still be queued, or sit past the end of the current mapping, either appended
+        # or written in a free block that was merged with appended ones since
+        if end > self._flushed:
+            self._flush_appends()
+        if end > self._mapped:
+            self._map_data()
 
-    def __delitem__(self, key) -> None:
-        pos = self._index.pop(key)
-        self.fh_data.seek(pos)
+        _willneed(self._data_map, pos, end)
+        return self._data_map[start:end]
 
-        siz = unpack(self.fh_data.read(4))[0]
-        self._setfree(pos, siz)
+    def __delitem__(self, key) -> None:
+        self._setfree(*self._index.pop(key))
+        # the block may be reused right away, the tombstone has to reach the index file
+        # in the same commit as any row pointing into it or a reopen would bring the key back
+        self._append_row(key, TOMBSTONE)
 
     def __setitem__(self, key: int, value: bytes):
 
+        # local, the split path looks it up three times
+        prefix = self.PREFIX_SIZE
+
         new_size = len(value)
-        if key in self._index:
-            old_pos = self._index[key]  # pos from index
-            self.fh_data.seek(old_pos)  # go to pos
-            old_size = unpack(self.fh_data.read(4))[0]
-            if new_size > old_size:  # bigger
+        if (old := self._index.get(key)) is not None:
+            old_pos, old_size = old  # pos and size from index
+            slack = old_size - new_size
 
-                # check for room elsewhere or add to the end of file
-                if new_pos := self._claim_free_space(new_size):
-                    self._setval(key, value, new_pos)
+            if not slack:  # same size, the common case for fixed size records
+                self._setval(key, value, old_pos)
 
-                else:
-                    self._addval(key, value)
+            elif slack >= prefix:  # smaller, the leftover is big enough to hold its own prefix
+                # the value in front of the leftover is live, so the merged block starts right
+                # behind it and its header is written together with the value
+                _, free_size = self._free(old_pos + new_size + prefix, slack - prefix)
+                self._setval(key, value, old_pos, pack(~free_size))
 
-                # new data doesn't fit, free the used storage
+            else:
+                # bigger, or the 1-3 leftover bytes can't hold a prefix so nothing would account for them.
+                # Either way the value moves elsewhere or to the end of file and the old block is freed
+                self._place(key, value)
                 self._setfree(old_pos, old_size)
-
-            elif new_size < old_size:  # smaller
-                if (
-                    free := (old_size - new_size)
-                ) > self.PREFIX_SIZE:  # there should be at least 5 bytes of free space because 4 are used for storing size
-                    self._setval(key, value, old_pos)
-                    new_free_pos = old_pos + new_size + self.PREFIX_SIZE
-                    new_free_size = free - self.PREFIX_SIZE
-                    self._setfree(new_free_pos, new_free_size)
-
-                else:
-                    # value += b"\0" * free
-                    self._setval(key, value, old_pos)
-            else:  # same size
-                self._setval(key, value, old_pos)
         else:
-            if new_pos := self._claim_free_space(new_size):
-                self._setval(key, value, new_pos)
+            # keys are stored as Uint 32's in the index file, a bad key has to be caught
+            # before any space gets claimed for its value
+            if not isinstance(key, int):
+                raise TypeError(f"keys have to be integers, not {type(key).__name__}")
+            if not 0 <= key <= MAX_KEY:
+                raise ValueError(f"key out of range(0, {MAX_KEY + 1}): {key}")
+            self._place(key, value)
+
+    def _place(self, key, val: bytes):
+        # reuse free space if there's a block that fits, otherwise append
+        if (claimed := self._claim_free_space(len(val))) is not None:
+            self._setval(key, val, *claimed)
+        else:
+            self._addval(key, val)
+
+    def _claim_free_space(self, size) -> Tuple[int, bytes] | None:
+        # best fit, the smallest block that fits exactly or leaves room for the prefix of the remainder.
+        # Anything in between would leave bytes behind that no prefix accounts for.
+        min_split = size + self.PREFIX_SIZE
+        free_pos = None
+
+        # small blocks sit in a handful of exact size buckets, checked smallest first
+        if size < self.MIN_BLOCKSIZE:
+            small = self._free_small
+            for free_size in (size, *range(min_split, self.MIN_BLOCKSIZE)):
+                if small.get(free_size):
+                    free_pos = small[free_size].pop()
+                    break
+
+        if free_pos is None:
+            by_size = self._free_by_size
+            i = bisect_left(by_size, size << 32)
+
+            for i in range(i, len(by_size)):
+                free_size = by_size[i] >> 32
+                if free_size == size or free_size >= min_split:
+                    break
             else:
-                self._addval(key, value)
+                return None
+
+            free_pos = by_size[i] & 0xFFFFFFFF
+            del by_size[i]
 
-    def _claim_free_space(self, size) -> int:
-        fspce = self._free_space
-        for i, block in enumerate(fspce):
-            free_pos, free_size = block
+        del self._free_by_start[free_pos]
+        free_end = free_pos + free_size + self.PREFIX_SIZE
 
-            if size < free_size:
-                del fspce[i]
-                new_free_pos = free_pos + size + self.PREFIX_SIZE
-                new_free_size = free_size - size - self.PREFIX_SIZE
+        if free_size == size:
+            del self._free_by_end[free_end]
+            return free_pos, b""
 
-                # may not be necesary if line below work
-                # self._setfree(new_free_pos, new_free_size)
+        new_free_pos = free_pos + min_split
+        new_free_size = free_size - min_split
 
-                # check if this is correct, speedtest ofcourse
-                self.fh_data.seek(new_free_pos)
-                self.fh_data.write(data_struct.pack(~new_free_size))
-                self._free_space.append((new_free_pos, new_free_size))
+        # the remainder keeps the end of the block it was split from,
+        # its header directly follows the value and is left to _setval
+        self._free_by_start[new_free_pos] = new_free_size
+        self._free_by_end[free_end] = new_free_pos
+        self._add_sized(new_free_pos, new_free_size)
 
-                return free_pos
+        return free_pos, pack(~new_free_size)
 
-            if size == free_size:
-                del fspce[i]
-                return free_pos
+    def _add_sized(self, pos, siz):
+        if siz < self.MIN_BLOCKSIZE:
+            self._free_small[siz].add(pos)
+        else:
+            insort(self._free_by_size, siz << 32 | pos)
+
+    def _del_sized(self, pos, siz):
+        if siz < self.MIN_BLOCKSIZE:
+            self._free_small[siz].remove(pos)
+        else:
+            by_size = self._free_by_size
+            del by_size[bisect_left(by_size, siz << 32 | pos)]
 
     def _setfree(self, pos, siz):
-        # check free blocks for a chance of coalescing
-        for i, free in enumerate(self._free_space):
-            # check for free blocks before new free block
-            if 4 + sum(free) == pos:
-                pos = free[0]
-                siz += free[1] + 4
-                del self._free_space[i]
-                break
-
-            # check for free blocks after new free block
-            elif (pos + siz + 4) == free[0]:
-                siz += free[1] + 4
-                del self._free_space[i]
-                break
-
-        self.fh_data.seek(pos)
-        self.fh_data.write(data_struct.pack(~siz))
-        self._free_space.append((pos, siz))
-
-        #  block is too small, no use to keep checking, add to fragments list, can be used later
-        # if (siz < self.MIN_BLOCKSIZE): 
-        #     self._fragments.append(pos)
-        #     return
+        if pos >= self._flushed:
+            self._flush_appends()
+        pos, siz = self._free(pos, siz)
+        _pwrite(self._data_fd, pack(~siz), pos)
+
+    def _free(self, pos, siz) -> Tuple[int, int]:
+        # a block that can be coalesced with the new one either starts where it ends
+        # or ends where it starts, both are a single dict lookup.
+        # Returns the merged block, writing its header is up to the caller
+        by_start = self._free_by_start
+        by_end = self._free_by_end
+
+        # check for a free block after new free block
+        next_pos = pos + siz + 4
+        if (next_siz := by_start.pop(next_pos, None)) is not None:
+            del by_end[next_pos + next_siz + 4]
+            self._del_sized(next_pos, next_siz)
+            siz += next_siz + 4
+
+        # check for a free block before new free block
+        if (prev_pos := by_end.pop(pos, None)) is not None:
+            prev_siz = by_start.pop(prev_pos)
+            self._del_sized(prev_pos, prev_siz)
+            pos = prev_pos
+            siz += prev_siz + 4
+
+        by_start[pos] = siz
+        by_end[pos + siz + 4] = pos
+        self._add_sized(pos, siz)
+        return pos, siz
 
 
     def close(self, t, v, tr):
         self.commit(cleanup=True)
         self.fh_index.flush()
         self.fh_data.flush()
+        if self._data_map is not None:
+            self._data_map.close()
+        # give back what was preallocated but never written
+        if self._allocated > self._eof:
+            os.ftruncate(self._data_fd, self._eof)
         self.fh_data.close()
         self.fh_index.close()
 
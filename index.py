@@ -3,7 +3,6 @@ from random import randint
 from time import perf_counter
 
 row = struct.Struct("2I")
-decode_rows = row.iter_unpack
 pack = row.pack_into
 test = tuple()
 test_d = {randint(0, 48909): randint(0, 345879) for _ in range(20)}
@@ -13,7 +12,9 @@ buffer = bytearray(8 * 20)
 def index(file: str) -> set:
     with open(file, "rb") as f:
         data = f.read()
-        a = dict(decode_rows(data))
+        # zipping the strided key and position columns keeps the row loop in C
+        with memoryview(data) as view, view.cast("I") as columns:
+            a = dict(zip(columns[0::2], columns[1::2]))
         return a
 
 